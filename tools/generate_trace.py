@@ -24,79 +24,239 @@ Usage:
 import json
 import os
 import argparse
-import re
+import concurrent.futures
+import contextlib
+import gc
+import heapq
+import itertools
+import mmap
+import operator
+import stat
 import sys
 
+# The first line of a .ninja_log file is this prefix followed by the
+# log format version.
+_HEADER_PREFIX = b"# ninja log v"
+
+# A compact JSON encoder, used to quote target names in trace events.
+_JSON_ENCODER = json.JSONEncoder(separators=(",", ":"), check_circular=False)
+
+# The approximate size of the .ninja_log chunks parsed at once.
+_PARSE_CHUNK_SIZE = 4 << 20
+
+# The number of trace events written to the output at once.
+_WRITE_BATCH_SIZE = 4096
+
 
 class Target:
-    """Represents a single line read for a .ninja_log file. Start and end times
-    are milliseconds."""
+    """Represents a single command read for a .ninja_log file. Start and end
+    times are milliseconds. Most commands have a single output |name|, the
+    names of any other outputs are stored in the |extra| list."""
+
+    __slots__ = ("start", "end", "name", "extra")
 
-    def __init__(self, start, end):
+    def __init__(self, start, end, name):
         self.start = start
         self.end = end
-        self.targets = []
+        self.name = name
+        self.extra = None
 
 
-def read_targets(log, timestamp_delta):
-    """Reads all targets from .ninja_log file |log_file|, sorted by start
-    time"""
-    header = log.readline()
-    m = re.search(r"^# ninja log v(\d+)\n$", header)
-    assert m, "unrecognized ninja log version %r" % header
-    version = int(m.group(1))
+def read_targets(data, timestamp_delta):
+    """Reads all targets from the raw content |data| of a .ninja_log file,
+    sorted by start time. |data| can be a bytes or mmap object."""
+    header_end = data.find(b"\n")
+    if header_end < 0:
+        header_end = len(data)
+    header = data[:header_end].rstrip(b"\r")
+    version = header[len(_HEADER_PREFIX) :]
+    assert (
+        header.startswith(_HEADER_PREFIX) and version.isdigit()
+    ), "unrecognized ninja log version %r" % header
+    version = int(version)
     assert 5 <= version <= 6, "unsupported ninja log version %d" % version
+    pos = header_end + 1
     if version == 6:
         # Skip header line
-        next(log)
+        pos = data.find(b"\n", pos) + 1 or len(data)
 
-    targets = {}
-    for line in log:
-        if line.startswith("#"):
+    # Parsing allocates one object per target but never creates reference
+    # cycles, so pause the cyclic garbage collector, which would otherwise
+    # repeatedly scan all of them as they are created.
+    gc_was_enabled = gc.isenabled()
+    gc.disable()
+    try:
+        targets = _parse_targets(data, pos, timestamp_delta)
+    finally:
+        if gc_was_enabled:
+            gc.enable()
+    return sorted(targets, key=lambda job: job.start)
+
+
+def _parse_targets(data, pos, timestamp_delta):
+    """Parses the .ninja_log entries found in |data| from offset |pos| into a
+    list of targets, in log order."""
+    starts = []
+    ends = []
+    names = []
+    cmdhashes = []
+    # Parse the log column-wise: split a chunk of whole lines into fields in
+    # one go, then slice out each column. This keeps the per-line work in C
+    # instead of running a Python loop over each line, while only a chunk
+    # of the log has to be copied out of |data| at a time.
+    size = len(data)
+    while pos < size:
+        end = data.find(b"\n", min(pos + _PARSE_CHUNK_SIZE, size) - 1) + 1 or size
+        lines = [
+            line for line in data[pos:end].splitlines() if not line.startswith(b"#")
+        ]
+        pos = end
+        if not lines:
             continue
-        start, end, _, name, cmdhash = line.strip().split("\t")  # Ignore restat.
-        start_ms = int(start) + timestamp_delta
-        end_ms = int(end) + timestamp_delta
-        targets.setdefault(cmdhash, Target(start_ms, end_ms)).targets.append(name)
-    return sorted(targets.values(), key=lambda job: job.start)
+        # Check that each line has exactly 5 fields, otherwise a short and a
+        # long line could shift the columns without changing the total.
+        assert all(
+            count == 4 for count in map(bytes.count, lines, itertools.repeat(b"\t"))
+        ), "malformed ninja log"
+        fields = b"\t".join(lines).split(b"\t")
+        starts += map(int, fields[0::5])
+        ends += map(int, fields[1::5])
+        # Ignore restat in fields[2::5].
+        names += fields[3::5]
+        cmdhashes += fields[4::5]
 
+    # Map each command hash to the index of its first line.
+    first_index = dict(zip(reversed(cmdhashes), range(len(cmdhashes) - 1, -1, -1)))
+    targets = {}
+    for index in sorted(first_index.values()):
+        targets[cmdhashes[index]] = Target(
+            starts[index] + timestamp_delta,
+            ends[index] + timestamp_delta,
+            names[index].decode(),
+        )
 
-class Threads:
-    """Tries to reconstruct the parallelism from a .ninja_log"""
+    # Commands with several outputs appear on several lines with the same
+    # hash, collect the extra output names in order.
+    if len(targets) != len(cmdhashes):
+        for index, cmdhash in enumerate(cmdhashes):
+            if index != first_index[cmdhash]:
+                target = targets[cmdhash]
+                if target.extra is None:
+                    target.extra = []
+                target.extra.append(names[index].decode())
 
-    def __init__(self):
-        self.workers = []  # Maps thread id to time that thread is occupied for.
+    return list(targets.values())
 
-    def alloc(self, target):
-        """Places target in an available thread, or adds a new thread."""
-        for worker in range(len(self.workers)):
-            if self.workers[worker] <= target.start:
-                self.workers[worker] = target.end
-                return worker
-        self.workers.append(target.end)
-        return len(self.workers) - 1
 
+def assign_threads(targets):
+    """Tries to reconstruct the parallelism from a .ninja_log. Places each of
+    |targets|, sorted by start time, in the lowest available thread, or adds
+    a new thread, and returns the list of their thread ids."""
+    # This runs once per target, so it is a single loop working on local
+    # variables only, rather than a method call per target.
+    tids = []
+    # A min-heap of (time that thread is occupied for, thread id) tuples,
+    # for busy threads.
+    workers = []
+    # A bitset of idle thread ids.
+    idle = 0
+    next_tid = 0
+    for target in targets:
+        # Mark threads that are done by the target's start as idle.
+        start = target.start
+        while workers and workers[0][0] <= start:
+            idle |= 1 << heapq.heappop(workers)[1]
+        if idle:
+            # Pick the lowest set bit of the idle bitset.
+            lowest = idle & -idle
+            idle ^= lowest
+            tid = lowest.bit_length() - 1
+        else:
+            tid = next_tid
+            next_tid += 1
+        heapq.heappush(workers, (target.end, tid))
+        tids.append(tid)
+    return tids
 
-def log_to_dicts(log, pid, timestamp_delta):
-    """Reads a file-like object |log| containing a .ninja_log, and yields one
-    about:tracing dict per command found in the log."""
-    threads = Threads()
+
+def log_to_events(data, pid, timestamp_delta):
+    """Reads the raw content |data| of a .ninja_log file, and yields one
+    (timestamp, about:tracing JSON event string) pair per command found in
+    the log, sorted by timestamp."""
     # Multiply the process number by 1000 to ensure that the recording tids
     # are unique. Otherwise these confuses the trace viewer which sees several
     # threads with overlapping events.
     pid = pid * 1000
-    for target in read_targets(log, timestamp_delta):
-        tid = pid + threads.alloc(target)
-        yield {
-            "name": "%0s" % ", ".join(target.targets),
-            "cat": "targets",
-            "ph": "X",
-            "ts": (target.start * 1000),
-            "dur": ((target.end - target.start) * 1000),
-            "pid": pid,
-            "tid": tid,
-            "args": {},
-        }
+    targets = read_targets(data, timestamp_delta)
+    for target, tid in zip(targets, assign_threads(targets)):
+        tid += pid
+        if target.extra is None:
+            name = target.name
+        else:
+            name = ", ".join([target.name] + target.extra)
+        ts = target.start * 1000
+        # Format the event directly, instead of building a dict to encode.
+        yield ts, (
+            f'{{"name":{_JSON_ENCODER.encode(name)},"cat":"targets","ph":"X",'
+            f'"ts":{ts},"dur":{(target.end - target.start) * 1000},'
+            f'"pid":{pid},"tid":{tid},"args":{{}}}}'
+        )
+
+
+def read_log_events(log_file, pid, timestamp_delta):
+    """Reads .ninja_log file |log_file|, and yields its (timestamp,
+    about:tracing JSON event string) pairs."""
+    # Memory-map the log and parse it as bytes, which lets the kernel page it
+    # in on demand, and avoids copying it whole or decoding it through a
+    # text file object. The file is opened as a raw descriptor since it is
+    # only needed to create the mapping, which keeps its own reference to it.
+    fd = os.open(log_file, os.O_RDONLY)
+    try:
+        log_info = os.fstat(fd)
+        if not stat.S_ISREG(log_info.st_mode):
+            # Pipes and other special files (e.g. from process substitution)
+            # cannot be mapped, read them whole instead.
+            data = b"".join(iter(lambda: os.read(fd, 1 << 20), b""))
+        elif log_info.st_size == 0:
+            # Empty files cannot be mapped.
+            data = b""
+        else:
+            data = mmap.mmap(fd, 0, access=mmap.ACCESS_READ)
+    finally:
+        os.close(fd)
+    try:
+        yield from log_to_events(data, pid, timestamp_delta)
+    finally:
+        # Unmap the log right away, even if the caller stops iterating early.
+        if isinstance(data, mmap.mmap):
+            data.close()
+
+
+def _read_log_event_list(log_file, pid, timestamp_delta):
+    """Same as read_log_events(), but returns a list that can be sent back
+    from a worker process."""
+    return list(read_log_events(log_file, pid, timestamp_delta))
+
+
+def write_trace(events, out):
+    """Writes the about:tracing JSON event strings of |events|, an iterable of
+    (timestamp, event string) pairs, as a single JSON array to the binary
+    stream |out|."""
+    # Stream the JSON array in batches of events, instead of collecting
+    # all entries in memory first, as large builds can generate hundreds
+    # of thousands of them. Each batch is joined and encoded at once, then
+    # written as bytes, bypassing the text layer of sys.stdout.
+    out.write(b"[")
+    separator = b""
+    events = iter(events)
+    while True:
+        batch = list(itertools.islice(events, _WRITE_BATCH_SIZE))
+        if not batch:
+            break
+        out.write(separator)
+        out.write(",".join([event for _, event in batch]).encode())
+        separator = b","
+    out.write(b"]")
 
 
 def main(argv):
@@ -107,22 +267,46 @@ def main(argv):
 
     args = parser.parse_args()
 
-    # Compute the timestamps of all log files.
-    log_timestamps = {}
-    for log_file in args.logs:
-        log_info = os.stat(log_file)
-        log_timestamps[log_file] = log_info.st_mtime
-
-    # Compute the minimal log timestamp, which will be used as the base
-    # for the final start/end values.
-    base_timestamp = min(log_timestamps.values())
-
-    entries = []
-    for pid, log_file in enumerate(args.logs):
-        timestamp_delta = log_timestamps[log_file] - base_timestamp
-        with open(log_file, "r") as log:
-            entries += list(log_to_dicts(log, pid, timestamp_delta))
-    json.dump(entries, sys.stdout)
+    if len(args.logs) > 1:
+        # Compute the timestamps of all log files, and use the minimal one
+        # as the base for the final start/end values.
+        log_timestamps = [os.stat(log_file).st_mtime for log_file in args.logs]
+        base_timestamp = min(log_timestamps)
+        timestamp_deltas = [
+            log_timestamp - base_timestamp for log_timestamp in log_timestamps
+        ]
+        pids = range(len(args.logs))
+
+        # Each log can be parsed independently, so do it in parallel in
+        # worker processes when several CPUs are available. Their events are
+        # then merged by timestamp, so that the final trace is sorted, which
+        # trace viewers prefer.
+        if hasattr(os, "sched_getaffinity"):
+            # Only count the CPUs this process is allowed to run on.
+            cpu_count = len(os.sched_getaffinity(0))
+        else:
+            cpu_count = os.cpu_count() or 1
+        max_workers = min(len(args.logs), cpu_count)
+        with contextlib.ExitStack() as stack:
+            if max_workers > 1:
+                executor = stack.enter_context(
+                    concurrent.futures.ProcessPoolExecutor(max_workers=max_workers)
+                )
+                all_events = executor.map(
+                    _read_log_event_list, args.logs, pids, timestamp_deltas
+                )
+            else:
+                # A single worker process would only add pickling and IPC
+                # costs, so generate the events of each log lazily in-process.
+                all_events = map(read_log_events, args.logs, pids, timestamp_deltas)
+            write_trace(
+                heapq.merge(*all_events, key=operator.itemgetter(0)),
+                sys.stdout.buffer,
+            )
+    else:
+        # A single log is its own base timestamp, so there is no need to
+        # stat it.
+        write_trace(read_log_events(args.logs[0], 0, 0.0), sys.stdout.buffer)
 
 
 if __name__ == "__main__":
@@ -29,18 +29,24 @@ See --help-usage for usage examples.
 import argparse
 import os
 import platform
+import signal
 import subprocess
 import sys
+import time
 import typing as T
 
 _DEFAULT_NAME = "jobserver_tokens"
 _IS_WINDOWS = sys.platform in ("win32", "cygwin")
 
+# Pre-allocated token bytes written to Posix pipes and FIFOs.
+_TOKENS = b"x" * 4096
+
 if _IS_WINDOWS:
     try:
         # This requires pywin32 to be installed.
         import win32event
         import win32api
+        import win32process
         import winerror
     except ModuleNotFoundError as e:
         print(
@@ -51,16 +57,14 @@ if _IS_WINDOWS:
 
     def create_sem(
         sem_name: str, job_count: int
-    ) -> T.Tuple[win32event.PyHandle, T.Dict[str, str]]:
-        """Create and initialize Win32 semaphore."""
+    ) -> T.Tuple[win32event.PyHandle, str]:
+        """Create Win32 semaphore, return its handle and MAKEFLAGS value."""
         assert job_count > 0, f"Token count must be strictly positive"
         handle = win32event.CreateSemaphore(
             None, job_count, job_count - 1, sem_name  # Default security attributes,
         )
         assert handle != 0, f"Error creating Win32 semaphore {winerror.GetLastError()}"
-        env = dict(os.environ)
-        env["MAKEFLAGS"] = " -j{job_count} --jobserver-auth=" + sem_name
-        return handle, env
+        return handle, f" -j{job_count} --jobserver-auth=" + sem_name
 
     def check_sem_count(handle: win32event.PyHANDLE, job_count: int) -> int:
         if job_count <= 1:
@@ -115,21 +119,26 @@ exit
 
 else:  # !_IS_WINDOWS
 
-    def create_pipe(job_count: int) -> T.Tuple[int, int, T.Dict[str, str]]:
-        """Create and fill Posix PIPE."""
+    def write_tokens(write_fd: int, count: int) -> None:
+        """Write |count| tokens to a pipe or FIFO, without allocating a new buffer."""
+        tokens = memoryview(_TOKENS)
+        while count > 0:
+            count -= os.write(write_fd, tokens[: min(count, len(_TOKENS))])
+
+    def create_pipe(job_count: int) -> T.Tuple[int, int, str]:
+        """Create and fill Posix PIPE, return its descriptors and MAKEFLAGS value."""
         read_fd, write_fd = os.pipe()
         os.set_inheritable(read_fd, True)
         os.set_inheritable(write_fd, True)
         assert job_count > 0, f"Token count must be strictly positive"
-        os.write(write_fd, (job_count - 1) * b"x")
-        env = dict(os.environ)
-        env["MAKEFLAGS"] = (
+        write_tokens(write_fd, job_count - 1)
+        makeflags = (
             f" -j{job_count} --jobserver-fds={read_fd},{write_fd} --jobserver-auth={read_fd},{write_fd}"
         )
-        return read_fd, write_fd, env
+        return read_fd, write_fd, makeflags
 
-    def create_fifo(path: str, job_count: int) -> T.Tuple[int, int, T.Dict[str, str]]:
-        """Create and fill Posix FIFO."""
+    def create_fifo(path: str, job_count: int) -> T.Tuple[int, int, str]:
+        """Create and fill Posix FIFO, return its descriptors and MAKEFLAGS value."""
         if os.path.exists(path):
             os.remove(path)
 
@@ -138,10 +147,8 @@ else:  # !_IS_WINDOWS
         read_fd = os.open(path, os.O_RDONLY | os.O_NONBLOCK)
         write_fd = os.open(path, os.O_WRONLY | os.O_NONBLOCK)
         assert job_count > 0, f"Token count must be strictly positive"
-        os.write(write_fd, (job_count - 1) * b"x")
-        env = dict(os.environ)
-        env["MAKEFLAGS"] = f" -j{job_count} --jobserver-auth=fifo:" + path
-        return read_fd, write_fd, env
+        write_tokens(write_fd, job_count - 1)
+        return read_fd, write_fd, f" -j{job_count} --jobserver-auth=fifo:" + path
 
     def print_usage() -> int:
         print(
@@ -181,10 +188,11 @@ exit
         read_count = 0
         while True:
             try:
-                token = os.read(read_fd, 1)
-                if len(token) == 0:  # End of pipe?
+                # Read as many tokens as possible per call.
+                tokens = os.read(read_fd, max(job_count, len(_TOKENS)))
+                if len(tokens) == 0:  # End of pipe?
                     break
-                read_count += 1
+                read_count += len(tokens)
             except BlockingIOError:
                 break
 
@@ -203,6 +211,52 @@ exit
 
         return 0
 
+    def run_command(command: T.List[str], pass_fds: T.Sequence[int] = ()) -> int:
+        """Run command and return its exit code.
+
+        This uses posix_spawn() when available, which avoids duplicating
+        this process with fork() first. The command inherits the current
+        environment and all inheritable file descriptors, which must
+        include |pass_fds|.
+        """
+        if not hasattr(os, "posix_spawnp"):
+            return subprocess.run(command, pass_fds=pass_fds).returncode
+        # Python ignores SIGPIPE and SIGXFSZ, restore their default handling
+        # in the command, as subprocess.run(restore_signals=True) does.
+        pid = os.posix_spawnp(
+            command[0],
+            command,
+            os.environ,
+            setsigdef=(signal.SIGPIPE, signal.SIGXFSZ),
+        )
+        try:
+            _, status = os.waitpid(pid, 0)
+        except KeyboardInterrupt:
+            # Like subprocess.run(), give the command, which received the
+            # same SIGINT, a short time to exit, then kill it. Always reap it
+            # before cleaning up the pool.
+            deadline = time.monotonic() + 0.25
+            while time.monotonic() < deadline:
+                if os.waitpid(pid, os.WNOHANG)[0] == pid:
+                    raise
+                time.sleep(0.01)
+            os.kill(pid, signal.SIGKILL)
+            os.waitpid(pid, 0)
+            raise
+        return os.waitstatus_to_exitcode(status)
+
+
+def default_job_count() -> int:
+    """Return the number of CPUs this process is allowed to run on."""
+    if hasattr(os, "sched_getaffinity"):
+        return len(os.sched_getaffinity(0))
+    if _IS_WINDOWS:
+        process_mask, _ = win32process.GetProcessAffinityMask(
+            win32api.GetCurrentProcess()
+        )
+        return bin(process_mask).count("1")
+    return os.cpu_count()
+
 
 def main() -> int:
     parser = argparse.ArgumentParser(
@@ -242,7 +296,7 @@ def main() -> int:
         "--job-count",
         action="store",
         type=int,
-        default=os.cpu_count(),
+        default=default_job_count(),
         help="Set token count, default is available CPUs count",
     )
 
@@ -262,9 +316,12 @@ def main() -> int:
         exit_code = ret.returncode
     elif _IS_WINDOWS:
         # Run with a Window semaphore.
-        handle, env = create_sem(args.name, job_count)
+        handle, makeflags = create_sem(args.name, job_count)
+        # Let the command inherit MAKEFLAGS from our own environment, instead
+        # of passing it a modified copy of it.
+        os.environ["MAKEFLAGS"] = makeflags
         try:
-            ret = subprocess.run(args.command, env=env)
+            ret = subprocess.run(args.command)
             exit_code = ret.returncode
 
             if exit_code == 0 and args.check:
@@ -275,18 +332,17 @@ def main() -> int:
         # Run with pipe descriptors.
         exit_code = 0
         delete_fifo = ""
+        pass_fds: T.Tuple[int, ...] = ()
         try:
             if args.pipe:
-                read_fd, write_fd, env = create_pipe(int(args.job_count))
-                ret = subprocess.run(
-                    args.command, env=env, pass_fds=(read_fd, write_fd)
-                )
+                read_fd, write_fd, makeflags = create_pipe(job_count)
+                pass_fds = (read_fd, write_fd)
             elif args.fifo:
-                read_fd, write_fd, env = create_fifo(args.fifo, int(args.job_count))
-                ret = subprocess.run(args.command, env=env)
+                read_fd, write_fd, makeflags = create_fifo(args.fifo, job_count)
                 delete_fifo = args.fifo
 
-            exit_code = ret.returncode
+            os.environ["MAKEFLAGS"] = makeflags
+            exit_code = run_command(args.command, pass_fds)
             if exit_code == 0 and args.check:
                 exit_code = check_pipe_tokens(read_fd, job_count)
 